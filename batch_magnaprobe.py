@@ -0,0 +1,355 @@
+# A Module to Clean and Plot Batches of MagnaProbe Data Files
+
+import argparse
+import functools
+import glob
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyproj
+import shapely
+
+import magnaprobe as mag
+import plot_magnaprobe as pltmp
+
+# polars runs the whole cleaning query multithreaded over Arrow-backed
+# columns; the batch worker uses it for CSV input when it is installed
+# and falls back to the pandas pipeline otherwise
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Batch settings pinned at module level so the pool workers do not need to
+# receive them with every task. Anything the CLI can override (the epsg
+# code) is passed to the workers explicitly instead, since spawn-start
+# workers re-import the module and would see only these defaults.
+header_row = 1
+junk_rows = 2
+cols_to_keep = ['timestamp', 'counter', 'Latitude',
+                'Longitude', 'Snow Depth m']
+calibration_prefix = 99
+cal_lower = 0.02
+cal_upper = 1.18
+epsg_code = 32606
+raw_extensions = ('*.dat', '*.csv', '*.xls', '*.xlsx')
+# the substrings _classify_columns and the pipeline dispatch on, plus
+# the two exact names consolidate_coords accepts for its labeled case;
+# everything else is dead weight and is dropped at read time
+raw_col_substrings = ('timestamp', 'counter', 'tude', 'depth')
+raw_col_names = ('lat', 'lon')
+
+
+def _keep_raw_col(col):
+    """usecols filter: keep only columns the cleaning pipeline consumes.
+
+    Matches by the same substrings the pipeline itself dispatches on, so
+    any depth or coordinate variant the single-file CLI accepts (e.g. a
+    bare 'Depth' or 'SnowDepth_m') also survives the batch read."""
+    lc = str(col).lower()
+    return lc in raw_col_names or \
+        any(s in lc for s in raw_col_substrings)
+
+
+# explicit dtypes for the kept columns (both common capitalizations);
+# safe now that the non-numeric unit rows are skipped at read time
+raw_dtypes = {'Counter': 'Int64', 'counter': 'Int64',
+              'Latitude': 'float64', 'latitude': 'float64',
+              'Longitude': 'float64', 'longitude': 'float64',
+              'latitude_a': 'float64', 'Longitude_a': 'float64',
+              'LatitudeDDDDD': 'float64', 'LongitudeDDDDD': 'float64',
+              'DepthCm': 'float64', 'Depth_m': 'float64'}
+
+# one WGS 84 -> UTM transformer per epsg code per process; building a
+# Transformer pays a CRS database lookup and PROJ pipeline compilation,
+# so do not repeat that for every file in the batch
+_transformers = {}
+
+
+def _utm_transformer(code):
+    """Return a cached WGS 84 -> UTM pyproj Transformer"""
+    if code not in _transformers:
+        _transformers[code] = pyproj.Transformer.from_crs(
+            4326, code, always_xy=True)
+    return _transformers[code]
+
+
+def build_file_dict(input_dir):
+    """Find raw MagnaProbe files and key a dict of per-file results by path"""
+    raw_files = []
+    for ext in raw_extensions:
+        raw_files.extend(glob.glob(os.path.join(input_dir, ext)))
+    mp_file_dict = {f: {} for f in sorted(raw_files)}
+    print("Found %s raw files in %s" % (len(mp_file_dict), input_dir))
+    return mp_file_dict
+
+
+def _clean_polars(raw_file):
+    """Clean one raw CSV file with polars expressions.
+
+    Mirrors the pandas pipeline in magnaprobe.py (coordinate
+    consolidation, cm to m, calibration culling, near-zero snapping) as
+    polars queries over the same column-name heuristics, converting to
+    pandas only at the GeoDataFrame boundary."""
+    df = pl.read_csv(raw_file, skip_rows=header_row,
+                     skip_rows_after_header=junk_rows)
+    df = df.rename({c: c.lower() for c in df.columns})
+    # consolidate coordinates (cases match mag.consolidate_coords)
+    coord_cols = sorted([c for c in df.columns if 'tude' in c])
+    if len(coord_cols) == 2:
+        lat = pl.col(coord_cols[0]).cast(pl.Float64)
+        lon = pl.col(coord_cols[1]).cast(pl.Float64)
+    elif 'lat' in df.columns:
+        lat = pl.col('lat').cast(pl.Float64)
+        lon = pl.col('lon').cast(pl.Float64)
+    else:
+        dec_deg_cols = sorted([c for c in coord_cols if 'dd' in c])
+        int_deg_cols = sorted([c for c in coord_cols if '_a' in c])
+        lat = pl.col(int_deg_cols[0]).cast(pl.Float64) + \
+            pl.col(dec_deg_cols[0]).cast(pl.Float64)
+        lon = pl.col(int_deg_cols[1]).cast(pl.Float64) + \
+            pl.col(dec_deg_cols[1]).cast(pl.Float64)
+    # snow depth to meters (cases match mag.convert_depth_cm_to_m)
+    depth_cols = sorted([c for c in df.columns if 'depth' in c])
+    depth = None
+    if len(depth_cols) != 1:
+        for c in depth_cols:
+            if 'cm' in c:
+                depth = pl.col(c).cast(pl.Float64) / 100.0
+            elif '_m' in c:
+                depth = pl.col(c).cast(pl.Float64)
+    else:
+        if 'cm' in depth_cols[0]:
+            depth = pl.col(depth_cols[0]).cast(pl.Float64) / 100.0
+        else:
+            depth = pl.col(depth_cols[0]).cast(pl.Float64)
+    df = df.with_columns(lat.alias('Latitude'), lon.alias('Longitude'),
+                         depth.alias('Snow Depth m'))
+    # cull by calibration counter prefix
+    df = df.filter(pl.col('counter').cast(pl.Utf8).str.slice(0, 2)
+                   != str(calibration_prefix))
+    # cull by calibration patterns; one shifted bottom/top test per
+    # offset in -3..3, combined exactly as in mag.drop_calibration_points
+    s = pl.col('Snow Depth m')
+    b = {k: (s.shift(k) < cal_lower).fill_null(False) for k in range(-3, 4)}
+    t = {k: (s.shift(k) > cal_upper).fill_null(False) for k in range(-3, 4)}
+    cal_patterns = \
+        (b[0] & t[-1]) | (b[0] & t[1]) | (t[0] & b[-1]) | (t[0] & b[1]) | \
+        (b[0] & b[-1] & b[-2]) | (t[0] & t[-1] & t[-2]) | \
+        (b[0] & b[1] & t[2]) | (t[0] & t[1] & b[2]) | \
+        (b[0] & b[-1] & t[-2] & t[-3]) | (t[0] & t[-1] & b[-2] & b[-3]) | \
+        (b[0] & b[1] & t[2] & t[3]) | (t[0] & t[1] & b[2] & b[3])
+    df = df.filter(~cal_patterns)
+    # snap small negative depths to zero; fill nulls to zero as well so
+    # missing readings clean the same way as the pandas path, whose
+    # "x if x >= 0 else 0" sends NaN to 0
+    df = df.with_columns(pl.when(s < 0).then(0.0).otherwise(s)
+                         .fill_null(0.0).alias('Snow Depth m'))
+    return df.select(cols_to_keep).to_pandas()
+
+
+def _clean_pandas(raw_file):
+    """Clean one raw file through the pandas pipeline in magnaprobe.py"""
+    df = mag.read_tabular(raw_file, header_row, junk_rows=junk_rows,
+                          usecols=_keep_raw_col, dtype=raw_dtypes)
+    # classify the header once and share the result
+    col_classes = mag._classify_columns(df.columns)
+    df = mag.consolidate_coords(df, col_classes)
+    df = mag.convert_depth_cm_to_m(df, col_classes)
+    df = mag.trim_cols(df, cols_to_keep)
+    df = mag.drop_calibration_points(df, calibration_prefix,
+                                     cal_lower, cal_upper)
+    df = mag.zero_out_near_zero_depths(df, 0.01)
+    return df
+
+
+def _clean_one_file(raw_file, epsg_code):
+    """Clean a single raw file to a UTM GeoDataFrame.
+
+    Top-level (picklable) worker for the batch pool. Returns the input path
+    with the result so the unordered pool output can be keyed back into the
+    file dict. The epsg code rides in with the task because spawn-start
+    workers re-import the module and would otherwise fall back to the
+    hard-coded default."""
+    if pl is not None and raw_file.split('.')[-1][:2] != 'xl':
+        df = _clean_polars(raw_file)
+    else:
+        df = _clean_pandas(raw_file)
+    # project the raw lon/lat arrays directly and build the UTM
+    # GeoDataFrame in one shot rather than round-tripping through a
+    # WGS 84 GeoDataFrame and gdf.to_crs per file
+    x, y = _utm_transformer(epsg_code).transform(
+        df['Longitude'].to_numpy(dtype='float64'),
+        df['Latitude'].to_numpy(dtype='float64'))
+    utm_df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(x, y),
+                              crs='epsg:%s' % epsg_code)
+    utm_df = mag.control_coord_precision(utm_df)
+    return raw_file, utm_df
+
+
+def _gdf_to_table(gdf):
+    """Serialize a cleaned GeoDataFrame to an Arrow table, geometry as WKB"""
+    flat = pd.DataFrame(gdf.drop(columns='geometry'))
+    flat['geometry'] = shapely.to_wkb(gdf.geometry.values)
+    return pa.Table.from_pandas(flat, preserve_index=False)
+
+
+def batch_clean(mp_file_dict, parquet_dst=None):
+    """Clean every raw file in the batch.
+
+    Files are independent of each other so they are farmed out to a process
+    pool. imap_unordered lets fast files come back while slow ones are still
+    being parsed.
+
+    Holding every cleaned frame in the dict makes peak memory grow with
+    the batch, so with parquet_dst set (requires pyarrow) each frame is
+    instead appended to that Parquet file as it comes back and dropped,
+    keeping the working set constant however large the campaign is."""
+    if parquet_dst is not None and pq is None:
+        raise ImportError('streaming batch output requires pyarrow')
+    files = list(mp_file_dict)
+    writer = None
+    # bind the (possibly CLI-overridden) epsg code into the worker so it
+    # reaches the pool regardless of the process start method
+    worker = functools.partial(_clean_one_file, epsg_code=epsg_code)
+    with mp.Pool(os.cpu_count()) as pool:
+        for f, utm_df in pool.imap_unordered(worker, files):
+            print("Cleaned %s" % f)
+            if parquet_dst is None:
+                mp_file_dict[f]['cleaned_utm_df'] = utm_df
+                # keep the depth array at hand for the plotting phase so
+                # it is not re-extracted from the frame per plot
+                mp_file_dict[f]['depth'] = \
+                    utm_df['Snow Depth m'].to_numpy()
+            else:
+                table = _gdf_to_table(utm_df)
+                if writer is None:
+                    writer = pq.ParquetWriter(parquet_dst, table.schema)
+                writer.write_table(table)
+    if writer is not None:
+        writer.close()
+        print("Streamed cleaned data to %s" % parquet_dst)
+    return mp_file_dict
+
+
+def read_concatenated(parquet_dst, columns=None):
+    """Read a streamed batch Parquet file back to a UTM GeoDataFrame"""
+    flat = pd.read_parquet(parquet_dst, columns=columns)
+    geometry = gpd.GeoSeries.from_wkb(flat.pop('geometry'))
+    return gpd.GeoDataFrame(flat, geometry=geometry,
+                            crs='epsg:%s' % epsg_code)
+
+
+def concatenate_data(mp_file_dict):
+    """Concatenate all cleaned data into a single GeoDataFrame.
+
+    When pyarrow is available the frames are concatenated as Arrow
+    tables, which stitches the column chunks together without copying
+    the values; geometry rides along as WKB and the CRS is assigned once
+    at the end. Otherwise a plain pd.concat is used."""
+    dfs = [mp_file_dict[f]['cleaned_utm_df'] for f in mp_file_dict]
+    if pa is not None and len(dfs) > 1:
+        flat = pa.concat_tables([_gdf_to_table(d) for d in dfs]).to_pandas()
+        geometry = gpd.GeoSeries.from_wkb(flat.pop('geometry'))
+        concat_df = gpd.GeoDataFrame(flat, geometry=geometry,
+                                     crs=dfs[0].crs)
+    else:
+        concat_df = pd.concat(dfs, ignore_index=True)
+    print("Concatenated %s cleaned files: %s total rows" %
+          (len(dfs), len(concat_df)))
+    return concat_df
+
+
+def _plot_one_file(task):
+    """Render the three standard plots for one cleaned file.
+
+    Top-level (picklable) worker for the plotting pool. Forces the
+    non-interactive Agg backend so no GUI backend is initialized in the
+    worker processes."""
+    import matplotlib
+    matplotlib.use('Agg')
+    utm_df, depths, title, fname_out = task
+    pltmp.line_plot(depths, title=title,
+                    save=pltmp.append_id(fname_out, 'line_plot'))
+    pltmp.plot_pdf(depths, title=title,
+                   save=pltmp.append_id(fname_out, 'histogram'))
+    pltmp.map_depth(utm_df, title=title,
+                    save=pltmp.append_id(fname_out, 'depth_map'))
+
+
+def batch_plots(mp_file_dict, output_dir):
+    """Save the standard line / histogram / map plots for each cleaned file.
+
+    Figure rendering is CPU-bound and independent per file, so the files
+    are farmed out to a process pool rather than rendered serially."""
+    tasks = []
+    for f in mp_file_dict:
+        title = os.path.basename(f)
+        fname_out = os.path.join(output_dir,
+                                 os.path.splitext(title)[0] + '.png')
+        tasks.append((mp_file_dict[f]['cleaned_utm_df'],
+                      mp_file_dict[f]['depth'], title, fname_out))
+    with ProcessPoolExecutor() as executor:
+        chunksize = max(1, len(tasks) // (4 * os.cpu_count()))
+        list(executor.map(_plot_one_file, tasks, chunksize=chunksize))
+
+
+def plot_concat_data(depths, output_dir, title='All MagnaProbe Data'):
+    """Save line and histogram plots for the whole batch's depth array"""
+    fname_out = os.path.join(output_dir, 'concatenated.png')
+    pltmp.line_plot(depths, title=title,
+                    save=pltmp.append_id(fname_out, 'line_plot'))
+    pltmp.plot_pdf(depths, title=title,
+                   save=pltmp.append_id(fname_out, 'histogram'))
+
+
+if __name__ == '__main__':
+    """Clean a Directory of Raw Files and Write Batch CSV, Shapefile, Plots"""
+    parser = argparse.ArgumentParser(
+        description='Utility to Clean Batches of MagnaProbe Data.')
+    parser.add_argument('input_dir', metavar='i', type=str,
+                        help='directory of raw magnaprobe data files')
+    parser.add_argument('output_dir', metavar='o', type=str,
+                        help='destination directory for batch output')
+    parser.add_argument('--epsg_code', default=epsg_code, type=int,
+                        help='UTM epsg code, e.g. 32606 for 6N')
+    parser.add_argument('--low_memory', action='store_true',
+                        help='stream cleaned data to a Parquet file instead '
+                             'of holding every file in memory (requires '
+                             'pyarrow; skips the per-file plots)')
+    parser.epilog = "Example of use: python batch_magnaprobe.py example_data output_data --epsg_code 32606"
+    args = parser.parse_args()
+
+    epsg_code = args.epsg_code
+    os.makedirs(args.output_dir, exist_ok=True)
+    mp_file_dict = build_file_dict(args.input_dir)
+    if args.low_memory:
+        parquet_dst = os.path.join(args.output_dir, 'all_UTM.parquet')
+        mp_file_dict = batch_clean(mp_file_dict, parquet_dst=parquet_dst)
+        concat_df = read_concatenated(parquet_dst)
+    else:
+        mp_file_dict = batch_clean(mp_file_dict)
+        concat_df = concatenate_data(mp_file_dict)
+    mag.save_as_csv(concat_df, os.path.join(args.output_dir, 'all_UTM.csv'))
+    mag.save_as_shp(concat_df, os.path.join(args.output_dir, 'all_UTM.shp'))
+    if args.low_memory:
+        all_depths = concat_df['Snow Depth m'].to_numpy()
+    else:
+        batch_plots(mp_file_dict, args.output_dir)
+        # the per-file depth arrays are already in hand; no pandas concat
+        # is needed just to plot the campaign-wide line and histogram
+        all_depths = np.concatenate(
+            [mp_file_dict[f]['depth'] for f in mp_file_dict])
+    plot_concat_data(all_depths, args.output_dir)
+    print('Batch Cleaning Complete.')
@@ -21,6 +21,9 @@ def read_tabular(raw_file, header_row):
 def strip_junk_rows(raw_df, first_n_rows):
     """Drop header rows that are not needed"""
     raw_df.drop(raw_df.index[:first_n_rows], inplace=True)
+    # restore a fresh RangeIndex so later shift/mask/concat steps stay on
+    # the fast contiguous-index path
+    raw_df.reset_index(drop=True, inplace=True)
     return raw_df
 
 
@@ -86,7 +89,8 @@ def convert_depth_cm_to_m(df):
 
 def trim_cols(df, list_of_cols_to_keep):
     """Remove all columns except list of specified columns"""
-    df = df.copy()[list_of_cols_to_keep]
+    # select before copying so only the kept columns are ever copied
+    df = df.loc[:, list_of_cols_to_keep].copy()
     return df
 
 
@@ -140,8 +144,18 @@ def drop_calibration_points(df, calibration_prefix, cal_lower, cal_upper):
     """
 
     print("Starting number of rows: %s" % len(df))
-    # drop data with calibration prefix, e.g. 99
-    dfc = df[df.counter.astype("str").str[:2] != str(calibration_prefix)]
+    # drop data with calibration prefix, e.g. 99. The counter is numeric so
+    # the leading two digits can be peeled off with one vectorized integer
+    # divide instead of a per-row string slice.
+    counter = pd.to_numeric(df["counter"], errors="coerce")
+    if counter.notna().all():
+        counter = counter.to_numpy(dtype="int64")
+        ndigits = np.floor(np.log10(np.maximum(counter, 1))).astype(int) + 1
+        divisor = 10 ** np.maximum(ndigits - 2, 0)
+        dfc = df[(counter // divisor) != calibration_prefix]
+    else:
+        # non-numeric counters fall back to the string prefix test
+        dfc = df[df.counter.astype("str").str[:2] != str(calibration_prefix)]
 
     print("Rows left after culling by counter prefix: %s" % len(dfc))
 
@@ -1,30 +1,133 @@
 # A Module to Clean MagnaProbe Data
 
+import os
+
 import pandas as pd
 import geopandas as gpd
 import argparse
 import numpy as np
+import shapely
 from shapely.geometry import Point
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
-
-def read_tabular(raw_file, header_row):
-    """Read raw MagnaProbe data (*. xls, *.dat, *.csv, etc.) to DataFrame"""
+# numba JIT-compiles the calibration window scan to a single C loop; the
+# numpy shift-matrix path below covers installs without it
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+try:
+    # copy-on-write avoids defensive copies between pipeline steps; it is
+    # the default from pandas 3 and the option is gone in some versions
+    pd.set_option('mode.copy_on_write', True)
+except (KeyError, ValueError):
+    pass
+
+
+def read_tabular(raw_file, header_row, junk_rows=0, usecols=None, dtype=None):
+    """Read raw MagnaProbe data (*. xls, *.dat, *.csv, etc.) to DataFrame.
+
+    Raw files carry many more columns than the cleaning pipeline keeps, so
+    callers that know the layout can pass usecols (list or callable) and
+    dtype to skip materializing and type-inferring the dead columns.
+    junk_rows units/metadata rows after the header are skipped at read
+    time so they are never materialized (see strip_junk_rows)."""
+    skiprows = list(range(header_row + 1, header_row + 1 + junk_rows))
     if raw_file.split('.')[-1][:2] == 'xl':
-        raw_df = pd.read_excel(raw_file, header=header_row)
+        raw_df = _read_excel(raw_file, header_row, junk_rows, usecols, dtype)
     else:
-        raw_df = pd.read_csv(raw_file, header=header_row)
+        try:
+            # the pyarrow engine parses in parallel when it is available
+            # and the requested options are supported
+            raw_df = pd.read_csv(raw_file, header=header_row,
+                                 skiprows=skiprows, usecols=usecols,
+                                 dtype=dtype, engine='pyarrow')
+        except (ImportError, ValueError, TypeError):
+            raw_df = pd.read_csv(raw_file, header=header_row,
+                                 skiprows=skiprows, usecols=usecols,
+                                 dtype=dtype)
+    return raw_df
+
+
+def _read_excel(raw_file, header_row, junk_rows, usecols, dtype):
+    """Read an Excel file while avoiding a full workbook load where possible.
+
+    pd.read_excel pulls the whole workbook into memory and is an order of
+    magnitude slower than a columnar read, so the parsed sheet (header
+    applied, junk rows dropped) is cached as a Parquet sibling, keyed on
+    the parse settings, and reused while it is newer than the workbook.
+    The first pass streams rows via python-calamine when that is
+    installed."""
+    # the cached frame already has header_row/junk_rows applied, so the
+    # parse settings are part of the cache key
+    cache_file = '%s.h%s_j%s.parquet' % (os.path.splitext(raw_file)[0],
+                                         header_row, junk_rows)
+    if os.path.exists(cache_file) and \
+            os.path.getmtime(cache_file) >= os.path.getmtime(raw_file):
+        raw_df = pd.read_parquet(cache_file)
+    else:
+        try:
+            from python_calamine import CalamineWorkbook
+            rows = CalamineWorkbook.from_path(raw_file) \
+                .get_sheet_by_index(0).to_python()
+            raw_df = pd.DataFrame(rows[header_row + 1 + junk_rows:],
+                                  columns=[str(c) for c in rows[header_row]])
+        except ImportError:
+            raw_df = pd.read_excel(
+                raw_file, header=header_row,
+                skiprows=list(range(header_row + 1,
+                                    header_row + 1 + junk_rows)))
+        try:
+            raw_df.to_parquet(cache_file, index=False)
+        except (ImportError, ValueError, TypeError, OSError):
+            pass  # no parquet backend, mixed-type sheet, or read-only dir
+    if usecols is not None:
+        if callable(usecols):
+            raw_df = raw_df[[c for c in raw_df.columns if usecols(c)]]
+        else:
+            raw_df = raw_df[[c for c in raw_df.columns if c in usecols]]
+    if dtype is not None:
+        raw_df = raw_df.astype({c: t for c, t in dtype.items()
+                                if c in raw_df.columns})
     return raw_df
 
 
 def strip_junk_rows(raw_df, first_n_rows):
     """Drop header rows that are not needed"""
     raw_df.drop(raw_df.index[:first_n_rows], inplace=True)
+    # restore a fresh RangeIndex so later shift/mask/concat steps stay on
+    # the fast contiguous-index path
+    raw_df.reset_index(drop=True, inplace=True)
     return raw_df
 
 
-def consolidate_coords(df):
+def _classify_columns(columns):
+    """Classify raw column names in one pass.
+
+    Returns the lower-case rename map plus the coordinate and depth column
+    groups that consolidate_coords and convert_depth_cm_to_m dispatch on,
+    so a file's header is scanned once instead of once per function.
+    Batch callers can compute this per file and pass it to both."""
+    lower_map = {}
+    coord_cols = []
+    depth_cols = []
+    for c in columns:
+        lc = str(c).lower()
+        lower_map[c] = lc
+        if 'tude' in lc:
+            coord_cols.append(lc)
+        if 'depth' in lc:
+            depth_cols.append(lc)
+    coord_cols = sorted(coord_cols)
+    return {'lower_map': lower_map,
+            'coord': coord_cols,
+            'coord_dd': sorted([c for c in coord_cols if 'dd' in c]),
+            'coord_int': sorted([c for c in coord_cols if '_a' in c]),
+            'depth': sorted(depth_cols)}
+
+
+def consolidate_coords(df, col_classes=None):
     """Consolidate geospatial coordinate information.
 
     Coordinates may be split over many fields. There are at least 3 cases
@@ -33,13 +136,15 @@ def consolidate_coords(df):
     2. Coordinates are stored in only two fields but are labeled (great!)
     3. Coordinates are split over many fields (e.g. decimal degrees in one,
     integer degrees in another (yikes!)
-    Note: This if-else code should be abstracted away to a dictionary to
-    better handle new cases in the future."""
+    The column groups come from _classify_columns; pass its result in to
+    avoid rescanning the header."""
 
+    if col_classes is None:
+        col_classes = _classify_columns(df.columns)
     # make input columns lower case for string matching
-    df.columns = [c.lower() for c in df.columns]
-    # get columns with coordinate info via pattern match
-    coord_cols = sorted([col for col in df.columns if 'tude' in col.lower()])
+    df = df.rename(columns=col_classes['lower_map'])
+    # columns with coordinate info, already pattern matched
+    coord_cols = col_classes['coord']
     # case 1
     if len(coord_cols) == 2:
         df['Latitude'] = df[coord_cols[0]].astype('float')
@@ -50,10 +155,10 @@ def consolidate_coords(df):
         df['Longitude'] = df['lon'].astype('float')
     # case 3
     else:
-        dec_deg_cols = sorted([col for col in coord_cols if 'dd' in col])
+        dec_deg_cols = col_classes['coord_dd']
         latitude_dd = df[dec_deg_cols[0]].astype('float')
         longitude_dd = df[dec_deg_cols[1]].astype('float')
-        int_deg_cols = sorted([col for col in coord_cols if '_a' in col])
+        int_deg_cols = col_classes['coord_int']
         latitude_int = df[int_deg_cols[0]].astype('float')
         longitude_int = df[int_deg_cols[1]].astype('float')
         df['Latitude'] = latitude_int + latitude_dd
@@ -61,13 +166,17 @@ def consolidate_coords(df):
     return df
 
 
-def convert_depth_cm_to_m(df):
+def convert_depth_cm_to_m(df, col_classes=None):
     """Convert snow depth in cm to snow depth in m. cm column is retained.
     Again this is messy because there multiple cases. For example one of the
     raw fields name is 'depthBattVolts' so we need to a more careful
     pattern match for which field actually has the snow depth data."""
 
-    depth_cols = sorted([col for col in df.columns if 'depth' in col.lower()])
+    if col_classes is not None:
+        depth_cols = col_classes['depth']
+    else:
+        depth_cols = sorted(
+            [col for col in df.columns if 'depth' in col.lower()])
     # multiple fields case
     if len(depth_cols) != 1:
         for i in depth_cols:
@@ -86,10 +195,55 @@ def convert_depth_cm_to_m(df):
 
 def trim_cols(df, list_of_cols_to_keep):
     """Remove all columns except list of specified columns"""
-    df = df.copy()[list_of_cols_to_keep]
+    # select before copying so only the kept columns are ever copied
+    df = df.loc[:, list_of_cols_to_keep].copy()
     return df
 
 
+def _cal_mask_python(d, cal_lower, cal_upper):
+    """Flag calibration points with one pass over the depth array.
+
+    d[i+k] here corresponds to row 3-k of the shift matrices in
+    _cal_mask_numpy (pandas shift(-1), the 'prev' series in the original
+    notation, is the row below). Written so numba can compile it to a
+    tight loop; see the module-level njit import."""
+    n = d.shape[0]
+    out = np.zeros(n, np.bool_)
+    for i in range(n):
+        b0 = d[i] < cal_lower
+        t0 = d[i] > cal_upper
+        if not (b0 or t0):
+            continue
+        b_d1 = d[i + 1] < cal_lower if i + 1 < n else False
+        t_d1 = d[i + 1] > cal_upper if i + 1 < n else False
+        b_d2 = d[i + 2] < cal_lower if i + 2 < n else False
+        t_d2 = d[i + 2] > cal_upper if i + 2 < n else False
+        b_d3 = d[i + 3] < cal_lower if i + 3 < n else False
+        t_d3 = d[i + 3] > cal_upper if i + 3 < n else False
+        b_u1 = d[i - 1] < cal_lower if i - 1 >= 0 else False
+        t_u1 = d[i - 1] > cal_upper if i - 1 >= 0 else False
+        b_u2 = d[i - 2] < cal_lower if i - 2 >= 0 else False
+        t_u2 = d[i - 2] > cal_upper if i - 2 >= 0 else False
+        b_u3 = d[i - 3] < cal_lower if i - 3 >= 0 else False
+        t_u3 = d[i - 3] > cal_upper if i - 3 >= 0 else False
+        # A-B, A-A-B and A-A-A-B patterns, same 12 as the numpy path
+        out[i] = ((b0 and t_d1) or (b0 and t_u1) or
+                  (t0 and b_d1) or (t0 and b_u1) or
+                  (b0 and b_d1 and b_d2) or (t0 and t_d1 and t_d2) or
+                  (b0 and b_u1 and t_u2) or (t0 and t_u1 and b_u2) or
+                  (b0 and b_d1 and t_d2 and t_d3) or
+                  (t0 and t_d1 and b_d2 and b_d3) or
+                  (b0 and b_u1 and t_u2 and t_u3) or
+                  (t0 and t_u1 and b_u2 and b_u3))
+    return out
+
+
+if njit is not None:
+    _cal_mask = njit(cache=True)(_cal_mask_python)
+else:
+    _cal_mask = None
+
+
 def drop_calibration_points(df, calibration_prefix, cal_lower, cal_upper):
     """Drop calibration data points.
 
@@ -104,57 +258,64 @@ def drop_calibration_points(df, calibration_prefix, cal_lower, cal_upper):
     """
 
     print("Starting number of rows: %s" % len(df))
-    # drop data with calibration prefix, e.g. 99
-    dfc = df[df.counter.astype('str').str[:2] != str(calibration_prefix)]
+    # drop data with calibration prefix, e.g. 99. The counter is numeric so
+    # the leading two digits can be peeled off with one vectorized integer
+    # divide instead of a per-row string slice.
+    counter = pd.to_numeric(df['counter'], errors='coerce')
+    if counter.notna().all():
+        counter = counter.to_numpy(dtype='int64')
+        ndigits = np.floor(np.log10(np.maximum(counter, 1))).astype(int) + 1
+        divisor = 10 ** np.maximum(ndigits - 2, 0)
+        dfc = df[(counter // divisor) != calibration_prefix]
+    else:
+        # non-numeric counters fall back to the string prefix test
+        dfc = df[df.counter.astype('str').str[:2] != str(calibration_prefix)]
 
     print("Rows left after culling by counter prefix: %s" % len(dfc))
 
-    # find rows with depths near cal_lower or cal_upper
-    # this gets GNARLY and should be abstracted away to a dict using a loop
-    mp_bottom = dfc['Snow Depth m'] < cal_lower
-    mp_top = dfc['Snow Depth m'] > cal_upper
-    # check previous row
-    prev_mp_bottom = dfc['Snow Depth m'].shift(-1) < cal_lower
-    prev_mp_top = dfc['Snow Depth m'].shift(-1) > cal_upper
-    # check if next row
-    next_mp_bottom = dfc['Snow Depth m'].shift(+1) < cal_lower
-    next_mp_top = dfc['Snow Depth m'].shift(+1) > cal_upper
-    # check 2nd previous row
-    prev2_mp_bottom = dfc['Snow Depth m'].shift(-2) < cal_lower
-    prev2_mp_top = dfc['Snow Depth m'].shift(-2) > cal_upper
-    # check 2nd next
-    next2_mp_bottom = dfc['Snow Depth m'].shift(+2) < cal_lower
-    next2_mp_top = dfc['Snow Depth m'].shift(+2) > cal_upper
-    # check 3rd previous row
-    prev3_mp_bottom = dfc['Snow Depth m'].shift(-3) < cal_lower
-    prev3_mp_top = dfc['Snow Depth m'].shift(-3) > cal_upper
-    # check 3rd next row
-    next3_mp_bottom = dfc['Snow Depth m'].shift(+3) < cal_lower
-    next3_mp_top = dfc['Snow Depth m'].shift(+3) > cal_upper
-    # A-B calibration patterns
-    # depth too low and previous depth too high
-    cal1 = (mp_bottom) & (prev_mp_top)
-    # depth too low and next depth too high
-    cal2 = (mp_bottom) & (next_mp_top)
-    # depth too high and previous depth too low
-    cal3 = (mp_top) & (prev_mp_bottom)
-    # depth too high and next depth too low
-    cal4 = (mp_top) & (next_mp_bottom)
-    # A-A-B patterns e.g. low-low-high
-    cal5 = (mp_bottom) & (prev_mp_bottom) & (prev2_mp_bottom)
-    cal6 = (mp_top) & (prev_mp_top) & (prev2_mp_top)
-    cal7 = (mp_bottom) & (next_mp_bottom) & (next2_mp_top)
-    cal8 = (mp_top) & (next_mp_top) & (next2_mp_bottom)
-    # A-A-A-B patterns
-    cal9 = (mp_bottom) & (prev_mp_bottom) & (prev2_mp_top) & (prev3_mp_top)
-    cal10 = (mp_top) & (prev_mp_top) & (prev2_mp_bottom) & (prev3_mp_bottom)
-    cal11 = (mp_bottom) & (next_mp_bottom) & (next2_mp_top) & (next3_mp_top)
-    cal12 = (mp_top) & (next_mp_top) & (next2_mp_bottom) & (next3_mp_bottom)
-    # OR condition for all calibration patterns
-    cal_patterns = cal1 | cal2 | cal3 | cal4 | cal5 | cal6 | cal7 | cal8 |\
-        cal9 | cal10 | cal11 | cal12
+    d = dfc['Snow Depth m'].to_numpy(dtype='float64')
+    if _cal_mask is not None:
+        # JIT-compiled single pass over the depth array
+        cal_patterns = _cal_mask(d, cal_lower, cal_upper)
+        df2 = dfc[~cal_patterns]
+        print("Rows left ec culling by calibration patterns: %s" % len(df2))
+        return df2
+    # find rows with depths near cal_lower or cal_upper at shifts -3..3.
+    # Instead of 24 separate shifted/compared Series we fill two boolean
+    # shift matrices from a single depth array: row 3+k of B (or T) holds
+    # the bottom (or top) test for the depth series shifted by k, with the
+    # positions shifted in from beyond the ends left False.
+    n = len(d)
+    B = np.zeros((7, n), dtype=bool)
+    T = np.zeros((7, n), dtype=bool)
+    for k in range(-3, 4):
+        window = d[max(0, -k):n - max(0, k)]
+        B[3 + k, max(0, k):n + min(0, k)] = window < cal_lower
+        T[3 + k, max(0, k):n + min(0, k)] = window > cal_upper
+    # B[3]/T[3] is the unshifted row, B[2]/T[2] the previous row,
+    # B[4]/T[4] the next row, and so on out to +/-3.
+    # One tuple of B/T rows to AND together per calibration pattern:
+    patterns = (
+        # A-B patterns, e.g. too low next to too high
+        (B[3], T[2]), (B[3], T[4]), (T[3], B[2]), (T[3], B[4]),
+        # A-A-B patterns, e.g. low-low-high
+        (B[3], B[2], B[1]), (T[3], T[2], T[1]),
+        (B[3], B[4], T[5]), (T[3], T[4], B[5]),
+        # A-A-A-B patterns
+        (B[3], B[2], T[1], T[0]), (T[3], T[2], B[1], B[0]),
+        (B[3], B[4], T[5], T[6]), (T[3], T[4], B[5], B[6]),
+    )
+    # OR the patterns into one preallocated mask through a single scratch
+    # buffer instead of allocating a fresh array per pattern
+    cal_patterns = np.zeros(n, dtype=bool)
+    scratch = np.empty(n, dtype=bool)
+    for terms in patterns:
+        np.bitwise_and(terms[0], terms[1], out=scratch)
+        for extra in terms[2:]:
+            np.bitwise_and(scratch, extra, out=scratch)
+        np.logical_or(cal_patterns, scratch, out=cal_patterns)
     # drop rows matching calibration patterns
-    df2 = dfc.drop(dfc[cal_patterns].index)
+    df2 = dfc[~cal_patterns]
     print("Rows left ec culling by calibration patterns: %s" % len(df2))
     return df2
 
@@ -168,18 +329,15 @@ def zero_out_near_zero_depths(df, tol):
     return df
 
 
-def create_geometry(df):
-    """Add Geometry column to specify that these are spatial coordinates for
-    point vector data"""
-    df['geometry'] = df.apply(lambda x: Point(
-        (float(x['Longitude']), float(x['Latitude']))), axis=1)
-    return df
-
-
 def create_geodataframe(df):
-    """Create GeoDataFrame with WGS 84 Spatial Reference"""
-    gdf = gpd.GeoDataFrame(df, geometry='geometry')
-    gdf.crs = ('epsg:4326')
+    """Create GeoDataFrame with WGS 84 Spatial Reference.
+
+    The point geometry is built straight from the coordinate arrays with
+    shapely.points (one C loop, no per-row Point constructor) and the crs
+    is set at construction so it is not validated a second time."""
+    geometry = shapely.points(df['Longitude'].to_numpy(dtype='float64'),
+                              df['Latitude'].to_numpy(dtype='float64'))
+    gdf = gpd.GeoDataFrame(df, geometry=geometry, crs='epsg:4326')
     return gdf
 
 
@@ -198,13 +356,18 @@ def control_coord_precision(df):
 
 def save_as_csv(df, out_dst):
     """Save clean data to CSV"""
-    df.to_csv(out_dst, index=False)
+    df.to_csv(out_dst, index=False, chunksize=50000)
     print("CSV file written to %s" % out_dst)
 
 
 def save_as_shp(gdf, out_dst):
     """Save clean data to point shapefile ready for GIS"""
-    gdf.to_file(out_dst)
+    try:
+        # pyogrio batches features through a C buffer instead of writing
+        # them one at a time like the fiona engine
+        gdf.to_file(out_dst, engine='pyogrio')
+    except (ImportError, ValueError):
+        gdf.to_file(out_dst)
     print("Shapefile written to %s" % out_dst)
 
 
@@ -224,8 +387,7 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     print("Cleaning MagnaProbe data file %s..." % args.raw_data)
-    df = read_tabular(args.raw_data, 1)
-    df = strip_junk_rows(df, 2)
+    df = read_tabular(args.raw_data, 1, junk_rows=2)
     df = consolidate_coords(df)
     df = convert_depth_cm_to_m(df)
     df = trim_cols(df, ['timestamp', 'counter', 'Latitude',
@@ -234,8 +396,7 @@ if __name__ == '__main__':
     df = zero_out_near_zero_depths(df, 0.01)
     print("Cleaned Data Preview:")
     print(df.head(5))
-    geom_df = create_geometry(df)
-    gdf = create_geodataframe(geom_df)
+    gdf = create_geodataframe(df)
     utm_df = convert_wgs_to_utm(gdf, args.epsg_code)
     utm_df = control_coord_precision(utm_df)
     print("UTM-Converted Preview: ")
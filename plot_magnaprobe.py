@@ -4,8 +4,11 @@ import pandas as pd
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
+import shapely
 import argparse
+import glob
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 # a UAF color pallete - why not!
 uaf_blue = '#236192'
@@ -14,48 +17,185 @@ uaf_gold = '#FFCD00'
 uaf_pantone_wheat = '#EFDBB2'
 uaf_red = '#A6192E'
 default_dpi = 144
+# above this many probes the depth map is rasterized (when datashader is
+# installed) instead of drawn as one marker per probe
+rasterize_threshold = 20000
+
+try:
+    # pyogrio reads shapefiles through vectorized C field decoding
+    # instead of fiona's per-feature Python objects
+    gpd.options.io_engine = 'pyogrio'
+except (AttributeError, ValueError):
+    pass
+
+# numba compiles the one-pass stats loop below; numpy reductions cover
+# installs without it
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# numexpr fuses the gaussian-curve expression in plot_pdf; plain numpy
+# covers installs without it
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
 
 
 def read_clean_data(clean_file):
     """Read MagnaProbe datafile already cleaned"""
     if clean_file.endswith('.csv'):
-        df = pd.read_csv(clean_file)
+        try:
+            # the pyarrow engine parses the csv in parallel
+            df = pd.read_csv(clean_file, engine='pyarrow')
+        except (ImportError, ValueError):
+            df = pd.read_csv(clean_file)
         return df
     elif clean_file.endswith('.shp'):
-        df = gpd.read_file(clean_file)
+        try:
+            # arrow batches move the decoded fields across in bulk
+            df = gpd.read_file(clean_file, engine='pyogrio',
+                               use_arrow=True)
+        except (ImportError, ValueError, TypeError):
+            df = gpd.read_file(clean_file)
         return df
     else:
         print("Please input a cleaned .shp or .csv file.")
 
 
+def _depth_col(df):
+    """Find the depth column name once per DataFrame, memoized on attrs"""
+    col = df.attrs.get('_depth_col')
+    if col is None:
+        # pandas' C-level str kernel scans the columns in one shot
+        mask = df.columns.str.contains('depth', case=False, regex=False)
+        col = df.columns[mask][0]
+        df.attrs['_depth_col'] = col
+    return col
+
+
 def get_depth(df):
-    depths = df[[col for col in df.columns if 'depth' in col.lower()][0]]
+    depths = df[_depth_col(df)]
     return depths
 
 
+def _depth_stats_python(arr):
+    """Accumulate count/min/max/mean/std in a single pass over the array.
+
+    Plain loop on purpose: numba compiles it to one tight scan (see the
+    module-level njit import) where the separate numpy reductions each
+    walk the whole array again."""
+    n = arr.shape[0]
+    mn = arr[0]
+    mx = arr[0]
+    s = 0.0
+    s2 = 0.0
+    for i in range(n):
+        x = arr[i]
+        if x < mn:
+            mn = x
+        if x > mx:
+            mx = x
+        s += x
+        s2 += x * x
+    mu = s / n
+    sigma = np.sqrt(max(s2 / n - mu * mu, 0.0))
+    return n, mn, mx, mu, sigma
+
+
+if njit is not None:
+    _depth_stats = njit(cache=True, fastmath=True)(_depth_stats_python)
+else:
+    _depth_stats = None
+
+
 def compute_depth_stats(depths):
     """Compute basic snow depth statistics."""
 
-    hs_N = int(len(depths))
-    hs_min = np.min(depths)
-    hs_max = np.max(depths)
-    hs_mu = np.mean(depths)
-    hs_sigma = np.std(depths)
+    # a contiguous float32 buffer halves the bytes every pass touches;
+    # plenty of precision for stats displayed to two decimals
+    arr = np.ascontiguousarray(depths, dtype=np.float32)
+    if _depth_stats is not None and len(arr):
+        n, mn, mx, mu, sigma = _depth_stats(arr)
+        return (int(n), float(mn), float(mx), float(mu), float(sigma))
+    hs_N = int(len(arr))
+    hs_min = np.min(arr)
+    hs_max = np.max(arr)
+    hs_mu = np.mean(arr)
+    hs_sigma = np.std(arr)
     hs_stats = (hs_N, hs_min, hs_max, hs_mu, hs_sigma)
     return hs_stats
 
 
+def _hist_counts_python(arr, lo, hi, n_bins):
+    """Count uniform-bin histogram occupancy in one pass.
+
+    Plain loop so numba can compile it (see the module-level njit
+    import); np.histogram's general-purpose digitize step is much slower
+    for the equal-width bins used here."""
+    out = np.zeros(n_bins, np.int64)
+    inv = n_bins / (hi - lo)
+    for i in range(arr.shape[0]):
+        k = int((arr[i] - lo) * inv)
+        if k == n_bins:
+            # the maximum value belongs in the last bin, as np.histogram
+            k -= 1
+        if 0 <= k < n_bins:
+            out[k] += 1
+    return out
+
+
+if njit is not None:
+    _hist_counts = njit(cache=True)(_hist_counts_python)
+else:
+    _hist_counts = None
+
+
+# shared annotation box style; built once instead of per plot call
+_stat_props = dict(boxstyle='round', facecolor=uaf_pantone_wheat, alpha=0.5)
+
+
 def make_stat_annotation(hs_stats):
     """Create annotation box with basic stats inside."""
 
-    textstr = 'N = %d\nmin = %.2f\nmax = %.2f\n$\mu=%.2f$\n$\sigma=%.2f$' % hs_stats
-    props = dict(boxstyle='round', facecolor=uaf_pantone_wheat, alpha=0.5)
-    return textstr, props
+    hs_N, hs_min, hs_max, hs_mu, hs_sigma = hs_stats
+    textstr = (f"N = {hs_N}\nmin = {hs_min:.2f}\nmax = {hs_max:.2f}\n"
+               f"$\\mu={hs_mu:.2f}$\n$\\sigma={hs_sigma:.2f}$")
+    return textstr, _stat_props
 
 
 def append_id(fname, id):
     """Utility function to rename output data"""
-    return fname.split('.')[0] + '_' + id + '.' + fname.split('.')[1]
+    # splitext keeps dots in the stem (e.g. Geo1.6_UTM.shp) intact where
+    # a bare split('.') mangled them
+    stem, ext = os.path.splitext(fname)
+    return f"{stem}_{id}{ext}"
+
+
+def _new_figure(figsize, save):
+    """Create a Figure and Axes for a plot.
+
+    Export runs (save set) build a bare Agg-backed Figure, so pyplot's
+    global figure registry and backend machinery stay out of the loop
+    entirely and there is nothing to close afterwards. Interactive runs
+    still go through plt.subplots so plt.show works."""
+    if save:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        return fig, ax
+    return plt.subplots(figsize=figsize)
+
+
+def _decorate(ax, *, title, xlabel, ylabel, tstr, box,
+              tpos=(0.05, 0.95), fontsize=12):
+    """Apply the shared title/labels/stat-box boilerplate to an Axes"""
+    ax.set(title=title, xlabel=xlabel, ylabel=ylabel)
+    ax.text(*tpos, tstr, transform=ax.transAxes, fontsize=fontsize,
+            verticalalignment='top', bbox=box)
 
 
 def line_plot(depths, title='MagnaProbe Snow Depth', save=False):
@@ -63,105 +203,226 @@ def line_plot(depths, title='MagnaProbe Snow Depth', save=False):
 
     hs_stats = compute_depth_stats(depths)
     tstr, box = make_stat_annotation(hs_stats)
-    fig, ax = plt.subplots(figsize=(8, 5))
-    ax.plot(depths, c=uaf_blue, lw=2)
-    ax.text(0.80, 0.95, tstr, transform=ax.transAxes,
-            fontsize=12, verticalalignment='top', bbox=box)
-    ax.set_xlabel('MagnaProbe N')
-    ax.set_ylabel('Snow Depth $[m]$')
-    ax.set_title(title)
+    fig, ax = _new_figure((8, 5), save)
+    depths_arr = np.asarray(depths)
+    if len(depths_arr) > 50000:
+        # a 100k-segment polyline is wasted on a plot a few hundred
+        # pixels wide; draw the per-chunk min/max envelope instead -
+        # same visual shape with ~50x fewer vertices
+        chunk = 2000
+        starts = np.arange(0, len(depths_arr), chunk)
+        env_lo = np.minimum.reduceat(depths_arr, starts)
+        env_hi = np.maximum.reduceat(depths_arr, starts)
+        ax.fill_between(starts, env_lo, env_hi, color=uaf_blue)
+    else:
+        # rasterized flattens the line to a bitmap in vector exports
+        ax.plot(depths_arr, c=uaf_blue, lw=2, rasterized=True)
+    _decorate(ax, title=title, xlabel='MagnaProbe N',
+              ylabel='Snow Depth $[m]$', tstr=tstr, box=box,
+              tpos=(0.80, 0.95))
     if save:
-        plt.savefig(save, dpi=default_dpi, bbox_inches='tight')
-        plt.show()
+        # unmanaged Agg figure; nothing is registered with pyplot
+        fig.savefig(save, dpi=default_dpi, bbox_inches='tight')
     else:
         plt.show()
 
 
 def plot_pdf(depths, n_bins=40, title='MagnaProbe Snow Depth', save=False):
     """Computes and plots a normalized PDF"""
-    fig, ax = plt.subplots(figsize=(8, 5))
-    hs_stats = compute_depth_stats(depths)
+    fig, ax = _new_figure((8, 5), save)
+    # one contiguous array shared by the stats, histogram, and curve
+    depths_arr = np.asarray(depths, dtype='float64')
+    hs_stats = compute_depth_stats(depths_arr)
     tstr, box = make_stat_annotation(hs_stats)
+    # the stats tuple already holds mean and std; no second pass needed
+    hs_N, hs_min, hs_max, mu, sigma = hs_stats
+    # bin in one compiled pass when numba is present, else with numpy,
+    # and draw the bars in one call instead of letting plt.hist
+    # construct a Rectangle patch per bin
+    lo, hi = depths_arr.min(), depths_arr.max()
+    if _hist_counts is not None and hi > lo:
+        edges = np.linspace(lo, hi, n_bins + 1)
+        counts = _hist_counts(depths_arr, lo, hi, n_bins)
+        counts = counts / (counts.sum() * (edges[1] - edges[0]))
+    else:
+        counts, edges = np.histogram(depths_arr, bins=n_bins, density=True)
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    ax.bar(centers, counts, width=np.diff(edges), edgecolor='k',
+           align='center')
+    # evaluate the gaussian on a dense grid for a smooth curve
+    xs = np.linspace(edges[0], edges[-1], 512)
+    invnorm = 1.0 / (sigma * np.sqrt(2 * np.pi))
+    half_inv_var = 0.5 / (sigma * sigma)
+    if ne is not None:
+        # numexpr fuses the expression into one pass over xs instead of
+        # a temporary array per operator
+        ln = ne.evaluate("invnorm * exp(-(xs - mu)**2 * half_inv_var)")
+    else:
+        ln = invnorm * np.exp(-(xs - mu) ** 2 * half_inv_var)
 
-    sigma = np.std(depths)
-    mu = np.mean(depths)
-    count, bins, ignored = plt.hist(
-        depths, n_bins, density=True, histtype='bar', edgecolor='k')
-    ln = 1 / (sigma * np.sqrt(2 * np.pi)) * \
-        np.exp(- (bins - mu)**2 / (2 * sigma**2))
-
-    h = ax.plot(bins, ln, color=uaf_blue, linewidth=2, label='PDF')
+    h = ax.plot(xs, ln, color=uaf_blue, linewidth=2, label='PDF')
     h[0].set_color(uaf_red)
-    ax.set_xlabel('Snow Depth $[m]$')
-    ax.set_ylabel('Normalized Frequency')
-    ax.set_title(title)
-    ax.text(0.05, 0.95, tstr, transform=ax.transAxes,
-            fontsize=12, verticalalignment='top', bbox=box)
+    _decorate(ax, title=title, xlabel='Snow Depth $[m]$',
+              ylabel='Normalized Frequency', tstr=tstr, box=box)
     if save:
-        plt.savefig(save, dpi=default_dpi, bbox_inches='tight')
-        plt.show()
+        # unmanaged Agg figure; nothing is registered with pyplot
+        fig.savefig(save, dpi=default_dpi, bbox_inches='tight')
     else:
         plt.show()
 
 
+def _rasterize_depths(coords, depths_arr, xmin, xmax, ymin, ymax):
+    """Aggregate mean depth onto a regular grid with datashader.
+
+    Returns the grid, or None when datashader is not installed. For very
+    large transects one imshow image renders far faster than stroking a
+    marker per probe and keeps saved figures small."""
+    try:
+        import datashader as ds
+    except ImportError:
+        return None
+    cvs = ds.Canvas(plot_width=1200, plot_height=1200,
+                    x_range=(xmin, xmax), y_range=(ymin, ymax))
+    pts = pd.DataFrame({'x': coords[:, 0], 'y': coords[:, 1],
+                        'd': depths_arr})
+    agg = cvs.points(pts, 'x', 'y', ds.mean('d'))
+    return agg.values
+
+
 def map_depth(gdf, title='MagnaProbe Snow Depth Map', save=False):
     """Create map of probe locations with points colored by depth"""
-    dcol_name = [col for col in gdf.columns if 'depth' in col.lower()][0]
     depths = get_depth(gdf)
     hs_stats = compute_depth_stats(depths)
     tstr, box = make_stat_annotation(hs_stats)
-    ext = [gdf['geometry'].x.min(), gdf['geometry'].x.max(),
-           gdf['geometry'].y.min(), gdf['geometry'].y.max()]
-    fig_x = int((ext[1] - ext[0]) / (ext[3] - ext[2])) + 6
-    fig_y = int((ext[3] - ext[2]) / (ext[1] - ext[0])) + 6
-
-    if fig_y > fig_x:
-        fig_x += 3
-
-    if type(gdf) == gpd.geodataframe.GeoDataFrame:
-        fig, ax = plt.subplots(1, 1, figsize=(fig_x, fig_y))
-        gdf.plot(column=dcol_name, ax=ax, legend=True,
-                 legend_kwds={'label': "Snow Depth [m]", 'orientation': "vertical"})
-        ax.set_ylabel('UTM $m$ N')
-        ax.set_xlabel('UTM $m$ E')
-        ax.set_title(title)
-        ax.text(0.70, 0.65, tstr, transform=ax.transAxes,
-                fontsize=14, verticalalignment='top', bbox=box)
+    if isinstance(gdf, gpd.GeoDataFrame):
+        # decode every geometry exactly once; the same (N, 2) array
+        # feeds the extent reductions and the scatter call
+        coords = shapely.get_coordinates(gdf.geometry.values)
+        xmin, ymin = coords.min(axis=0)
+        xmax, ymax = coords.max(axis=0)
+        fig_x = int((xmax - xmin) / (ymax - ymin)) + 6
+        fig_y = int((ymax - ymin) / (xmax - xmin)) + 6
+
+        if fig_y > fig_x:
+            fig_x += 3
+
+        fig, ax = _new_figure((fig_x, fig_y), save)
+        depths_arr = np.asarray(depths)
+        grid = None
+        if len(depths_arr) > rasterize_threshold:
+            grid = _rasterize_depths(coords, depths_arr,
+                                     xmin, xmax, ymin, ymax)
+        if grid is not None:
+            sc = ax.imshow(grid, extent=(xmin, xmax, ymin, ymax),
+                           origin='lower', cmap='viridis')
+        else:
+            # quantize depths to 256 colormap indices up front: a uint8
+            # per probe instead of a float64, and NoNorm makes the
+            # normalization step a pass-through. 256 levels is all a
+            # continuous colorbar can show anyway.
+            lo, hi = float(depths_arr.min()), float(depths_arr.max())
+            if hi > lo:
+                levels = np.linspace(lo, hi, 257)
+                idx = np.clip(np.searchsorted(levels, depths_arr) - 1,
+                              0, 255).astype(np.uint8)
+            else:
+                levels = None
+                idx = np.zeros(len(depths_arr), np.uint8)
+            # one vectorized PathCollection for all probes rather than
+            # geopandas' per-feature plotting dispatch
+            # the fixed 0-255 norm reduces to one affine pass over the
+            # indices; no data-dependent vmin/vmax scan at draw time
+            sc = ax.scatter(coords[:, 0], coords[:, 1], c=idx,
+                            cmap=plt.get_cmap('viridis', 256),
+                            norm=mpl.colors.Normalize(0, 255), s=10)
+        cbar = fig.colorbar(sc, ax=ax, label="Snow Depth [m]",
+                            orientation="vertical")
+        if grid is None and levels is not None:
+            # ticks live in index space; map them back to depths so the
+            # bar's endpoints read exactly min and max
+            ticks = np.linspace(0, 255, 6)
+            cbar.set_ticks(ticks)
+            cbar.set_ticklabels([f"{lo + t / 255 * (hi - lo):.2f}"
+                                 for t in ticks])
+        _decorate(ax, title=title, xlabel='UTM $m$ E', ylabel='UTM $m$ N',
+                  tstr=tstr, box=box, tpos=(0.70, 0.65), fontsize=14)
         plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
     else:
         print("Todo: write x,y coords to csv upon crs transform")
+        return
     if save:
-        plt.savefig(save, dpi=default_dpi, bbox_inches='tight')
-        plt.show()
+        # unmanaged Agg figure; nothing is registered with pyplot
+        fig.savefig(save, dpi=default_dpi, bbox_inches='tight')
     else:
         plt.show()
 
 
+def _run_plot(task):
+    """Render one of the three standard plots.
+
+    Top-level (picklable) worker so the CLI can fan the independent
+    line/pdf/map renders out to separate processes. Forces the Agg
+    backend before drawing so workers never touch a GUI backend."""
+    mpl.use('Agg')
+    kind, data, title, save = task
+    if kind == 'line':
+        line_plot(data, title=title, save=save)
+    elif kind == 'pdf':
+        plot_pdf(data, title=title, save=save)
+    else:
+        map_depth(data, title=title, save=save)
+
+
 if __name__ == '__main__':
     """Generate Plots from Cleaned MagnaProbe Data"""
     parser = argparse.ArgumentParser(description='Plot Clean MagnaProbe Data.')
-    parser.add_argument('clean_data', metavar='c', type=str,
-                        help='path to clean magnaprobe data file')
+    parser.add_argument('clean_data', metavar='c', type=str, nargs='+',
+                        help='path(s) or glob pattern(s) of clean '
+                             'magnaprobe data files')
     parser.add_argument('--save_plots', default=False,
                         type=lambda x: (str(x).lower() == 'true'))
     parser.epilog = "Example of use: python plot_magnaprobe.py output_data/Geo1_6_UTM.shp --save_plots true"
     args = parser.parse_args()
 
-    clean_df = read_clean_data(args.clean_data)
-    snow_depths = get_depth(clean_df)
-    title = args.clean_data.split('/')[-1]
-    fname_out = os.path.join('output_data', (title.split('.')[-2] + ".png"))
     if args.save_plots:
+        # pure export run: switch to Agg so no GUI backend is initialized
+        mpl.use('Agg')
+
+    # expand glob patterns so a quoted 'output_data/*.shp' works; plain
+    # paths pass through unchanged. Processing every file in this one
+    # process amortizes the interpreter and matplotlib import cost.
+    clean_files = []
+    for pattern in args.clean_data:
+        matches = sorted(glob.glob(pattern))
+        clean_files.extend(matches if matches else [pattern])
+
+    tasks = []
+    for clean_file in clean_files:
+        clean_df = read_clean_data(clean_file)
+        if clean_df is None:
+            continue
+        snow_depths = get_depth(clean_df)
+        title = os.path.basename(clean_file)
+        fname_out = os.path.join('output_data',
+                                 os.path.splitext(title)[0] + '.png')
+        if args.save_plots:
+            tasks += [
+                ('line', snow_depths, title,
+                 append_id(fname_out, 'line_plot')),
+                ('pdf', snow_depths, title,
+                 append_id(fname_out, 'histogram')),
+                ('map', clean_df, title,
+                 append_id(fname_out, 'depth_map')),
+            ]
+        else:
+            print("Not Saving Figures.")
+            line_plot(snow_depths, title=title)
+            plot_pdf(snow_depths, title=title)
+            map_depth(clean_df, title=title)
+    if tasks:
         print("Saving figures to output_data directory.")
-        line_plot(snow_depths, title=title,
-                  save=append_id(fname_out, 'line_plot'))
-        plot_pdf(snow_depths, title=title,
-                 save=append_id(fname_out, 'histogram'))
-        map_depth(clean_df, title=title,
-                  save=append_id(fname_out, 'depth_map'))
-    else:
-        print("Not Saving Figures.")
-        line_plot(snow_depths, title=title)
-        plot_pdf(snow_depths, title=title)
-        map_depth(clean_df, title=title)
+        # all file x plot renders are independent; fan them out together
+        n_workers = min(len(tasks), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(_run_plot, tasks))
     print("Plotting Complete.")